@@ -5,32 +5,38 @@ Upbit DCA Bot for GitHub Actions
 요구사항:
 1) 새벽 4시~오전 10시(KST) '매 정시' 실행 → 정각~+30분 내에서만 매수 시도
 2) WINDOW_MINUTES=30 (env로 조정 가능)
-3) 그날 이미 주문된(접수/체결) 종목은 이후 시도에서 스킵
+3) 그날 이미 주문된(접수/체결) 종목은 이후 시도에서 스킵 (identifier 중복 응답으로 판단)
 4) 주문이 발생하면 텔레그램으로 즉시 알림
 
 필수 Secrets/ENV:
   UPBIT_ACCESS_KEY, UPBIT_SECRET_KEY
   TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID
-의존성: requests, tzdata, pyjwt
+선택 ENV:
+  DCA_DAEMON=1 → cron 없이 상주 프로세스로 실행 (평일 허용시각 정각마다 깨어나 1회 실행,
+                 세션/연결 풀을 실행 간에 재사용)
+의존성: requests, orjson
 """
 
-import os, json, uuid, time, hashlib, logging
-from datetime import datetime
-from zoneinfo import ZoneInfo
+import os, sys, time, hmac, atexit, base64, hashlib, logging, functools, itertools, threading
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlencode
 
-import jwt
-import requests
-from requests import HTTPError
+# requests / orjson / concurrent.futures 는 처음 쓰는 시점에 import
+# (DCA_PAUSE·시간외 실행의 시작 비용 절감)
 
 # ===== 기본 설정 =====
-KST = ZoneInfo("Asia/Seoul")
+_KST_OFFSET = 9 * 3600   # KST는 UTC+9 고정 (DST 없음) → tzdata 조회 없이 고정 오프셋 사용
+KST = timezone(timedelta(seconds=_KST_OFFSET), "KST")
 
 # 시간 설정 (워크플로 env로 제어)
 WINDOW_MINUTES    = int(os.environ.get("WINDOW_MINUTES", "30"))   # 정각~+30분
 STRICT_TIME_ONLY  = os.environ.get("STRICT_TIME_ONLY", "true").lower() == "true"
 ALLOWED_HOURS_KST = os.environ.get("ALLOWED_HOURS_KST", "4,5,6,7,8,9,10")
 ALLOWED_HOURS     = {int(h.strip()) for h in ALLOWED_HOURS_KST.split(",") if h.strip()}
+ALLOWED_HOURS_MASK = 0   # bit h = 1 → h시 허용
+for _h in ALLOWED_HOURS:
+    if 0 <= _h <= 23:   # 범위 밖 시각은 원래도 일치할 수 없으므로 무시 (음수 시프트 방지)
+        ALLOWED_HOURS_MASK |= 1 << _h
 
 # 예산/수수료/기타
 DAILY_BUDGET_KRW  = float(os.environ.get("DAILY_BUDGET_KRW", "40000"))
@@ -38,11 +44,15 @@ PAIRS             = [("KRW-BTC", 0.5), ("KRW-ETH", 0.5)]
 FEE_RATE          = float(os.environ.get("UPBIT_KRW_FEE", "0.0005"))
 MIN_ORDER_KRW     = float(os.environ.get("UPBIT_MIN_ORDER_KRW", "5000"))
 DCA_PAUSE         = os.environ.get("DCA_PAUSE", "0") == "1"
+DCA_DAEMON        = os.environ.get("DCA_DAEMON", "0") == "1"
+_FEE_DIVISOR      = 1.0 + FEE_RATE
+_MIN_ORDER_INT    = int(MIN_ORDER_KRW)
 
 # Upbit API
 API               = "https://api.upbit.com"
 ENDPOINT_ORDER    = "/v1/orders"
-ENDPOINT_GET_ONE  = "/v1/order"   # GET ?identifier=...
+_TIMEOUT          = (4.0, 12.0)   # (connect, read) 초 — 핸드셰이크 지연은 빨리 실패
+_PREWARM_LEAD_SEC = 5             # 데몬 모드: 정각 몇 초 전에 Upbit 연결을 미리 열어 둠
 
 # Keys
 ACCESS_KEY        = os.environ.get("UPBIT_ACCESS_KEY")
@@ -52,90 +62,172 @@ SECRET_KEY        = os.environ.get("UPBIT_SECRET_KEY")
 TG_TOKEN          = os.environ.get("TELEGRAM_BOT_TOKEN", "").strip()
 TG_CHAT_ID        = os.environ.get("TELEGRAM_CHAT_ID", "").strip()
 
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+# JWT(HS256) 서명 준비물: 헤더와 HMAC 키 스케줄(ipad/opad)은 실행 중 고정 → copy()로 재사용
+_JWT_HEADER_B64   = _b64url(b'{"alg":"HS256","typ":"JWT"}')
+_HMAC_PROTO       = hmac.new((SECRET_KEY or "").encode(), digestmod=hashlib.sha256)  # 누락 시 _require_env가 처리
+_SHA512_PROTOTYPE = hashlib.sha512()   # copy()로 해시 컨텍스트 생성/알고리즘 조회 생략
+_NONCE_SEQ        = itertools.count(1)  # next()는 GIL 아래 원자적 → 주문 스레드 간 중복 없음
+
+@functools.cache
+def _session():
+    """HTTP 세션 (keep-alive 연결 재사용 → 두 번째 요청부터 TLS 핸드셰이크 생략)
+
+    호스트별 풀: api.upbit.com, api.telegram.org. urllib3가 소켓에 TCP_NODELAY를 기본 설정.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=0))
+    s.headers.update({"Accept": "application/json"})
+    atexit.register(s.close)
+    return s
+
 def _require_env():
     missing = [k for k in ("UPBIT_ACCESS_KEY", "UPBIT_SECRET_KEY")]
     for k in missing:
         if not os.environ.get(k):
             raise RuntimeError(f"환경변수 누락: {k}")
 
-def _is_weekday_kst(now: datetime) -> bool:
-    return now.weekday() <= 4  # Mon=0..Sun=6
+def _kst_parts() -> tuple[int, int, int]:
+    """(요일, 시, 분) KST — zoneinfo 없이 UTC+9 산술로 계산"""
+    tm = time.gmtime(time.time() + _KST_OFFSET)
+    return tm.tm_wday, tm.tm_hour, tm.tm_min
 
-def _is_target_window(now: datetime) -> bool:
-    if not STRICT_TIME_ONLY:
-        return True
-    return (now.hour in ALLOWED_HOURS) and (0 <= now.minute <= WINDOW_MINUTES)
+def _should_run(wd: int, h: int, m: int) -> bool:
+    """평일(Mon=0..Fri=4)이고 허용시각 정각~+WINDOW_MINUTES 이내면 True"""
+    return wd <= 4 and (not STRICT_TIME_ONLY or ((ALLOWED_HOURS_MASK >> h) & 1 == 1 and m <= WINDOW_MINUTES))
+
+def _seconds_until_next_slot() -> float:
+    """다음 실행 시각(평일 허용시각 정각 KST)까지 남은 초"""
+    now = time.time() + _KST_OFFSET
+    slot = (int(now) // 3600 + 1) * 3600
+    for _ in range(7 * 24):
+        tm = time.gmtime(slot)
+        if tm.tm_wday <= 4 and (ALLOWED_HOURS_MASK >> tm.tm_hour) & 1 == 1:
+            return slot - now
+        slot += 3600
+    raise RuntimeError(f"허용시각 없음: ALLOWED_HOURS_KST={ALLOWED_HOURS_KST!r}")
+
+def _amount_net_of_fee(budget: float) -> int:
+    price = int(budget / _FEE_DIVISOR)
+    return price if price >= _MIN_ORDER_INT else _MIN_ORDER_INT
+
+def _order_template(market: str, weight: float) -> tuple:
+    """(시장, 주문금액, identifier 앞까지 인코딩된 쿼리)"""
+    price = _amount_net_of_fee(DAILY_BUDGET_KRW * weight)
+    qs_prefix = urlencode({"market": market, "side": "bid", "ord_type": "price", "price": str(price)}) + "&"
+    return market, price, qs_prefix
+
+# 예산/비중/수수료는 실행 중 고정 → 종목별 주문 템플릿을 미리 계산
+# 실행 시에는 날짜로 identifier만 붙이면 됨
+_ORDER_TEMPLATES = tuple(_order_template(m, w) for m, w in PAIRS)
+
+def _query_hash(query_string: bytes) -> str:
+    """JWT query_hash용 SHA512 (미리 만든 해시 객체를 복사해 사용)"""
+    h = _SHA512_PROTOTYPE.copy()
+    h.update(query_string)
+    return h.hexdigest()
+
+def _sign(payload: bytes) -> str:
+    """고정 헤더 HS256 JWT: header.payload 를 base64url로 이어 붙이고 HMAC 서명"""
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url(payload)
+    h = _HMAC_PROTO.copy()
+    h.update(signing_input)
+    return (signing_input + b"." + _b64url(h.digest())).decode()
 
-def _amount_net_of_fee(budget: float, fee_rate: float, min_total: float) -> int:
-    price = int(budget / (1.0 + fee_rate))
-    return max(price, int(min_total))
+def _nonce() -> str:
+    """요청마다 유일한 nonce: 시각(ns) + 프로세스 내 일련번호 (난수 syscall 없음)"""
+    return f"{time.time_ns()}-{next(_NONCE_SEQ)}"
 
-def _jwt_for_params(params: dict) -> str:
-    query_string = urlencode(params).encode()
-    query_hash = hashlib.sha512(query_string).hexdigest()
-    payload = {
+def _jwt_for_params(query_string: bytes) -> str:
+    import orjson
+    query_hash = _query_hash(query_string)
+    return _sign(orjson.dumps({
         "access_key": ACCESS_KEY,
-        "nonce": str(uuid.uuid4()),
+        "nonce": _nonce(),
         "query_hash": query_hash,
         "query_hash_alg": "SHA512",
-    }
-    return jwt.encode(payload, SECRET_KEY, algorithm="HS256")
+    }))
+
+_DUP_KW = ("already", "taken", "exists")
+
+def _iter_strings(x):
+    """dict 키/값, list 원소를 재귀적으로 훑어 문자열만 내보냄 (숫자/None 등은 건너뜀)"""
+    if isinstance(x, str):
+        yield x
+    elif isinstance(x, dict):
+        for k, v in x.items():
+            if isinstance(k, str):
+                yield k
+            yield from _iter_strings(v)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            yield from _iter_strings(v)
 
 def _is_duplicate_identifier_error(resp_json: dict) -> bool:
     if not isinstance(resp_json, dict):
         return False
     err = resp_json.get("error") or {}
     msg = (err.get("message") or "").lower()
-    if "identifier" in msg and ("already" in msg or "taken" in msg or "exists" in msg):
+    if "identifier" in msg and any(k in msg for k in _DUP_KW):
         return True
     if "errors" in err:
-        try:
-            s = json.dumps(err["errors"]).lower()
-            return "identifier" in s and ("already" in s or "taken" in s or "exists" in s)
-        except Exception:
-            pass
+        # 예: {"identifier": ["has already been taken"]} → 키와 값에 나뉘어 있어도 매칭
+        has_id = has_kw = False
+        for s in _iter_strings(err["errors"]):
+            s = s.lower()
+            has_id = has_id or "identifier" in s
+            has_kw = has_kw or any(k in s for k in _DUP_KW)
+            if has_id and has_kw:
+                return True
     return False
 
-def _order_exists_by_identifier(identifier: str) -> bool:
-    """identifier 주문이 있으면 True (그날 이미 주문됨으로 간주)"""
-    params = {"identifier": identifier}
-    token = _jwt_for_params(params)
-    headers = {"Authorization": f"Bearer {token}"}
+def _build_order_draft(qs_prefix: str, identifier: str) -> tuple:
+    """주문 요청(JWT 서명 포함)을 전송 직전이 아니라 미리 만들어 둠
+
+    requests의 요청 준비(헤더 병합/훅/쿠키/환경설정 조회)까지 끝낸 PreparedRequest를 돌려줌
+    → 전송 구간에서는 Session.send()만 호출
+    """
+    import requests
+    # 해시한 쿼리 문자열을 그대로 URL에 실어 보냄 (requests의 재인코딩과 서명 불일치 방지)
+    qs = qs_prefix + urlencode({"identifier": identifier})
+    token = _jwt_for_params(qs.encode())
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+    s = _session()
+    prep = s.prepare_request(requests.Request("POST", f"{API}{ENDPOINT_ORDER}?{qs}", headers=headers))
+    settings = s.merge_environment_settings(prep.url, {}, None, None, None)
+    return prep, settings
+
+def _place_market_buy(market: str, identifier: str, draft: tuple) -> dict:
+    prep, settings = draft
+    r = _session().send(prep, timeout=_TIMEOUT, **settings)
+    if r.ok:
+        # 성공 응답 본문은 전송 구간에서 파싱하지 않고 원문만 넘김 (_run_once가 요약 출력 직전에 주문 객체로 파싱)
+        return {"_raw": r.content}
+    import orjson
     try:
-        r = requests.get(API + ENDPOINT_GET_ONE, headers=headers, params=params, timeout=12)
-        return r.status_code == 200
+        resp_json = orjson.loads(r.content)
     except Exception:
-        # 조회 실패 시 보수적으로 False → 주문 시도
-        return False
+        resp_json = {"error_text": r.text}
+    if _is_duplicate_identifier_error(resp_json):
+        return {"result": "duplicate_identifier_accepted", "identifier": identifier, "market": market}
+    r.raise_for_status()
 
-def _place_market_buy(market: str, price_krw: int, identifier: str) -> dict:
-    params = {
-        "market": market,
-        "side": "bid",
-        "ord_type": "price",
-        "price": str(price_krw),
-        "identifier": identifier,
-    }
-    token = _jwt_for_params(params)
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
-    r = requests.post(API + ENDPOINT_ORDER, headers=headers, params=params, timeout=12)
+def _prewarm(session, url: str):
+    """url 호스트의 DNS/TCP/TLS 연결을 미리 세션 풀에 만들어 둠 (첫 요청의 핸드셰이크 제거)"""
     try:
-        r.raise_for_status()
-        return r.json()
-    except HTTPError as e:
-        try:
-            resp_json = e.response.json()
-        except Exception:
-            resp_json = {"error_text": getattr(e.response, "text", str(e))}
-        if _is_duplicate_identifier_error(resp_json):
-            return {"result": "duplicate_identifier_accepted", "identifier": identifier, "market": market}
-        raise
+        session.head(url, timeout=_TIMEOUT)   # 응답 본문은 필요 없음 (연결만 확보)
+    except Exception:
+        pass  # 예열 실패는 주문 로직에 영향 X
 
 def _send_telegram(text: str):
     if not (TG_TOKEN and TG_CHAT_ID):
         return
     try:
-        requests.post(
+        _session().post(
             f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage",
             data={"chat_id": TG_CHAT_ID, "text": text},
             timeout=10,
@@ -143,65 +235,123 @@ def _send_telegram(text: str):
     except Exception:
         pass  # 알림 실패는 주문 로직에 영향 X
 
+def _setup_logging():
+    """stderr 쓰기는 QueueListener 스레드가 담당 → 주문/서명 스레드는 큐에 넣기만 함"""
+    import queue
+    import logging.handlers
+    q = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(q, handler)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    listener.start()
+    atexit.register(listener.stop)   # 종료 전 큐에 남은 로그까지 출력
+
 def main() -> int:
     if DCA_PAUSE:
         print("Paused by DCA_PAUSE=1")
         return 0
 
     _require_env()
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-    now = datetime.now(KST)
+    _setup_logging()
+    if not DCA_DAEMON:
+        return _run_once()
 
-    if not _is_weekday_kst(now):
-        logging.info("스킵: 주말/휴일 %s", now.isoformat())
-        return 0
-    if not _is_target_window(now):
-        logging.info("스킵: 허용시간대 아님 (허용시각=%s, 윈도우=%d분) now=%s",
-                     sorted(ALLOWED_HOURS), WINDOW_MINUTES, now.isoformat())
+    while True:
+        try:
+            _run_once()
+        except Exception:
+            logging.exception("실행 실패 → 다음 실행 시각까지 대기")
+        wait = _seconds_until_next_slot()
+        logging.info("다음 실행까지 %.0f초 대기", wait)
+        deadline = time.monotonic() + wait + 1   # +1: 시계 오차로 정각 직전에 깨어 시간외로 스킵되는 것 방지
+        # 정각 직전에 Upbit 연결(DNS/TCP/TLS)을 끝까지 맺어 두고, 남은 시간만 대기
+        # HTTP/1.1은 연결당 요청 1개 → 동시 주문 수만큼 동시에 HEAD를 보내 연결을 따로 염 (풀 크기 pool_maxsize 이내)
+        time.sleep(max(wait - _PREWARM_LEAD_SEC, 0))
+        session = _session()
+        warmers = [threading.Thread(target=_prewarm, args=(session, API + "/v1/market/all"), daemon=True)
+                   for _ in _ORDER_TEMPLATES]
+        for t in warmers:
+            t.start()
+        for t in warmers:
+            t.join()
+        time.sleep(max(deadline - time.monotonic(), 0))
+
+def _run_once() -> int:
+    wd, h, m = _kst_parts()
+
+    if not _should_run(wd, h, m):
+        logging.info("스킵: 주말이거나 허용시간대 아님 (허용시각=%s, 윈도우=%d분) weekday=%d %02d:%02d KST",
+                     sorted(ALLOWED_HOURS), WINDOW_MINUTES, wd, h, m)
         return 0
 
-    date_tag = now.strftime("%Y%m%d")
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    import orjson
 
-    # 오늘 이미 주문된 종목은 스킵
-    markets_todo = []
-    for market, weight in PAIRS:
-        identifier = f"dca-{date_tag}-{market}"
-        if _order_exists_by_identifier(identifier):
-            logging.info("[%s] 오늘(identifier=%s) 주문 존재 → 스킵", market, identifier)
-        else:
-            markets_todo.append((market, weight))
+    now = datetime.now(KST)
 
-    if not markets_todo:
-        logging.info("오늘 모든 종목이 이미 주문 완료로 확인되어 종료.")
-        return 0
+    # 텔레그램 알림은 주문 응답을 받은 뒤에야 나가므로, 그동안 텔레그램 연결을 예열.
+    # (Upbit는 주문 전까지 겹칠 작업이 거의 없어 여기서 예열해도 주문보다 늦음 → 데몬 모드에서만 정각 전에 예열)
+    if TG_TOKEN and TG_CHAT_ID:
+        threading.Thread(target=_prewarm, args=(_session(), f"https://api.telegram.org/bot{TG_TOKEN}/getMe"),
+                         daemon=True).start()
+
+    date_tag = f"{now.year}{now.month:02d}{now.day:02d}"
 
-    # 주문 실행
+    # 서명까지 끝낸 주문 초안을 먼저 전부 만들고, 전송 구간에서는 보내기만 함
+    orders = []
+    for market, price_krw, qs_prefix in _ORDER_TEMPLATES:
+        identifier = f"dca-{date_tag}-{market}"
+        orders.append((market, price_krw, identifier, _build_order_draft(qs_prefix, identifier)))
+
+    # 종목별 주문은 서로 독립 → 동시에 전송.
+    # 사전 조회 없이 바로 주문하고, 오늘 이미 주문된 종목은 Upbit의 identifier 중복 응답으로 판별
     errors = 0
     results = []
-    for market, weight in markets_todo:
-        budget = DAILY_BUDGET_KRW * weight
-        price_krw = _amount_net_of_fee(budget, FEE_RATE, MIN_ORDER_KRW)
-        identifier = f"dca-{date_tag}-{market}"
-        try:
-            res = _place_market_buy(market, price_krw, identifier)
-            ok = res.get("result") in (None, "success", "duplicate_identifier_accepted")
-            results.append({"market": market, "price_krw": price_krw, "identifier": identifier, "api_result": res})
-            logging.info("[%s] 주문 결과: %s", market, res.get("result", "success"))
-
-            if ok:
-                _send_telegram(
-                    f"[Upbit DCA]\n체결 요청 완료: {market}\n금액: {price_krw} KRW\n식별자: {identifier}\n시간: {now.strftime('%Y-%m-%d %H:%M:%S')} KST"
-                )
-            else:
+    with ThreadPoolExecutor(max_workers=len(orders)) as ex:
+        futures = {
+            ex.submit(_place_market_buy, market, identifier, draft): (market, price_krw, identifier)
+            for market, price_krw, identifier, draft in orders
+        }
+
+        for fut in as_completed(futures):
+            market, price_krw, identifier = futures[fut]
+            try:
+                res = fut.result()
+                results.append({"market": market, "price_krw": price_krw, "identifier": identifier, "api_result": res})
+                if res.get("result") == "duplicate_identifier_accepted":
+                    logging.info("[%s] 오늘(identifier=%s) 주문 존재 → 스킵", market, identifier)
+                    continue
+                ok = res.get("result") in (None, "success")
+                # 종목별 결과는 마지막 요약 JSON에 모두 담기므로 DEBUG로만 남김
+                logging.debug("[%s] 주문 결과: %s", market, res.get("result", "success"))
+
+                if ok:
+                    # 알림은 같은 풀에 넘기고 바로 다음 결과 처리 (with 블록 종료 시 전송 완료까지 대기)
+                    ex.submit(
+                        _send_telegram,
+                        f"[Upbit DCA]\n체결 요청 완료: {market}\n금액: {price_krw} KRW\n식별자: {identifier}\n시간: {now.strftime('%Y-%m-%d %H:%M:%S')} KST",
+                    )
+                else:
+                    errors += 1
+            except Exception as e:
+                logging.exception("[%s] 주문 실패: %s", market, e)
                 errors += 1
-            time.sleep(0.25)
-        except Exception as e:
-            logging.exception("[%s] 주문 실패: %s", market, e)
-            errors += 1
 
-    print(json.dumps({
+    # 전송이 모두 끝난 뒤에 성공 응답 본문을 Upbit 주문 객체로 파싱 (파싱 실패 시 원문 텍스트 유지)
+    for item in results:
+        raw = item["api_result"].get("_raw")
+        if raw is not None:
+            try:
+                item["api_result"] = orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                item["api_result"] = raw.decode("utf-8", "replace")
+
+    summary = {
         "timestamp_kst": now.isoformat(),
-        "weekday": now.weekday(),
+        "weekday": wd,
         "allowed_hours_kst": sorted(ALLOWED_HOURS),
         "window_minutes": WINDOW_MINUTES,
         "daily_budget_krw": DAILY_BUDGET_KRW,
@@ -209,7 +359,10 @@ def main() -> int:
         "fee_rate": FEE_RATE,
         "results": results,
         "errors": errors,
-    }, ensure_ascii=False, indent=2))
+    }
+    sys.stdout.flush()
+    sys.stdout.buffer.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2) + b"\n")
+    sys.stdout.buffer.flush()   # 데몬 모드는 종료하지 않으므로 실행마다 즉시 내보냄
 
     return 1 if errors else 0
 